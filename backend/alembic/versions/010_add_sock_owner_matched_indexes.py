@@ -0,0 +1,30 @@
+"""Add composite index for per-user unmatched sock queries
+
+Revision ID: 010
+Revises: 009
+Create Date: 2026-10-15
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '010'
+down_revision = '009'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # list_unmatched_socks: WHERE owner_id = ? AND is_matched = false ORDER BY created_at DESC
+    # The (owner_id, is_matched) prefix also serves the similarity search candidate fetch
+    op.create_index(
+        'ix_socks_owner_matched_created',
+        'socks',
+        ['owner_id', 'is_matched', sa.text('created_at DESC')]
+    )
+
+
+def downgrade():
+    op.drop_index('ix_socks_owner_matched_created', table_name='socks')
@@ -0,0 +1,35 @@
+"""Add per-user sock sequence counter
+
+Revision ID: 011
+Revises: 010
+Create Date: 2026-10-15
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '011'
+down_revision = '010'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.add_column(sa.Column('next_sock_seq', sa.Integer(), nullable=False, server_default='0'))
+    
+    # Seed the counter with the highest sequence id already handed out per user
+    op.execute("""
+        UPDATE users
+        SET next_sock_seq = COALESCE(
+            (SELECT MAX(user_sequence_id) FROM socks WHERE socks.owner_id = users.id),
+            0
+        )
+    """)
+
+
+def downgrade():
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('next_sock_seq')
@@ -0,0 +1,26 @@
+"""add thumbnail_path to socks
+
+Revision ID: 012
+Revises: 011
+Create Date: 2026-10-15
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '012'
+down_revision = '011'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Add thumbnail_path column to socks table (existing socks keep generating thumbnails on request)
+    op.add_column('socks', sa.Column('thumbnail_path', sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    # Remove thumbnail_path column from socks table
+    op.drop_column('socks', 'thumbnail_path')
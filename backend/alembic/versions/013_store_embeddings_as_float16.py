@@ -0,0 +1,50 @@
+"""Store sock embeddings as float16
+
+Revision ID: 013
+Revises: 012
+Create Date: 2026-10-15
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import numpy as np
+
+
+# revision identifiers, used by Alembic.
+revision = '013'
+down_revision = '012'
+branch_labels = None
+depends_on = None
+
+EMBEDDING_DIM = 1280  # EfficientNet-B0 output dimension
+
+socks = sa.table(
+    'socks',
+    sa.column('id', sa.Integer),
+    sa.column('embedding', sa.LargeBinary),
+)
+
+
+def _convert(from_dtype: str, to_dtype: str):
+    """Re-encode every embedding stored as from_dtype; already converted rows are left alone."""
+    connection = op.get_bind()
+    from_size = EMBEDDING_DIM * np.dtype(from_dtype).itemsize
+    rows = connection.execute(sa.select(socks.c.id, socks.c.embedding)).fetchall()
+    updates = [
+        {'sock_id': row.id, 'embedding': np.frombuffer(row.embedding, dtype=from_dtype).astype(to_dtype).tobytes()}
+        for row in rows
+        if len(row.embedding) == from_size
+    ]
+    if updates:
+        connection.execute(
+            socks.update().where(socks.c.id == sa.bindparam('sock_id')).values(embedding=sa.bindparam('embedding')),
+            updates
+        )
+
+
+def upgrade():
+    _convert('<f4', '<f2')
+
+
+def downgrade():
+    _convert('<f2', '<f4')
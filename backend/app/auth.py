@@ -148,14 +148,10 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
     return user
 
 
-def get_user_from_token(token: str, db: Session) -> Optional[User]:
-    """Get user from a token string without raising exceptions."""
+def get_email_from_token(token: str) -> Optional[str]:
+    """Decode a token string and return its subject email without raising exceptions."""
     try:
         payload = jwt.decode(token, settings.secret_key, algorithms=[settings.algorithm])
-        email: str = payload.get("sub")
-        if email is None:
-            return None
-        user = db.query(User).filter(User.email == email).first()
-        return user
+        return payload.get("sub")
     except JWTError:
         return None
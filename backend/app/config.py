@@ -1,5 +1,6 @@
 from pydantic_settings import BaseSettings
 from functools import lru_cache
+from typing import Optional
 
 
 class Settings(BaseSettings):
@@ -29,9 +30,19 @@ class Settings(BaseSettings):
     
     # Storage
     upload_dir: str = "./uploads"
+    max_upload_bytes: int = 20 * 1024 * 1024  # 20 MB, keep in sync with nginx client_max_body_size
+    embedding_cache_max_entries: int = 10000  # Cached upload embeddings kept on disk (~2.5 KB each), least recently used evicted
     
     # Model
     embedding_dim: int = 1280  # EfficientNet-B0 output dimension
+    rembg_model: str = "u2net"  # rembg model used for background removal (e.g. "u2netp" for the 4.7MB variant)
+    rembg_model_path: Optional[str] = None  # Custom U2-Net ONNX export (e.g. INT8-quantized), overrides rembg_model
+    background_workers: int = 1  # Worker processes for background removal, each loads its own rembg session
+    background_batch_size: int = 4  # Max uploads sent through U2-Net in one inference call
+    background_batch_window_ms: int = 200  # How long to wait for more uploads before running a partial batch
+    embedding_batch_size: int = 16  # Max uploads embedded in one EfficientNet forward pass
+    embedding_batch_window_ms: int = 5  # How long an upload waits for concurrent uploads to share one forward pass
+    search_batch_window_ms: int = 5  # How long a similarity search waits for concurrent searches to share one index call
     
     # Observability
     otlp_endpoint: str = "http://localhost:4318/v1/traces"  # OTLP HTTP endpoint for traces
@@ -1,9 +1,16 @@
+import asyncio
 import torch
 import torchvision.transforms as transforms
 from torchvision.models import efficientnet_b0, EfficientNet_B0_Weights
 from PIL import Image
 import numpy as np
-from typing import BinaryIO
+from typing import BinaryIO, List, Optional
+from app.config import get_settings
+
+
+# Embeddings are stored as raw little-endian float16 bytes (half the size of float32,
+# with no measurable effect on cosine similarity of unit-length vectors)
+EMBEDDING_DTYPE = np.dtype('<f2')
 
 
 class EmbeddingService:
@@ -40,60 +47,111 @@ class EmbeddingService:
         Returns:
             bytes: The embedding as bytes
         """
+        return self.embed_batch([self.preprocess(image_file)])[0]
+    
+    def preprocess(self, image_file: BinaryIO) -> torch.Tensor:
+        """Decode an image into the (3, 224, 224) model input tensor."""
         try:
-            # Load and preprocess image
-            image = Image.open(image_file).convert('RGB')
-            image_tensor = self.transform(image).unsqueeze(0)
-            
-            # Always use CPU for inference to avoid device issues
-            # This is more reliable across different environments
-            image_tensor = image_tensor.cpu()
-            
-            # Generate embedding
-            with torch.no_grad():
-                embedding = self.model.cpu()(image_tensor)
-                
-            # Flatten and convert to numpy
-            embedding = embedding.squeeze().numpy()
-            
-            # Normalize the embedding
-            embedding = embedding / np.linalg.norm(embedding)
-            
-            # Convert to bytes for storage
-            return embedding.tobytes()
+            # Load and preprocess image. For JPEGs, let libjpeg downscale in the DCT domain
+            # while decoding: Resize(256) only needs both sides to stay >= 256px.
+            image = Image.open(image_file)
+            image.draft('RGB', (256, 256))
+            image = image.convert('RGB')
+            return self.transform(image)
         except Exception as e:
             print(f"Error in create_embedding: {type(e).__name__}: {str(e)}")
             raise
     
-    @staticmethod
-    def embedding_from_bytes(embedding_bytes: bytes) -> np.ndarray:
-        """Convert stored embedding bytes back to numpy array."""
-        return np.frombuffer(embedding_bytes, dtype=np.float32)
-    
-    @staticmethod
-    def calculate_similarity(embedding1: np.ndarray, embedding2: np.ndarray) -> float:
-        """
-        Calculate cosine similarity between two embeddings.
+    def embed_batch(self, image_tensors: List[torch.Tensor]) -> List[bytes]:
+        """Run preprocessed images through the model in one forward pass, one embedding per image."""
+        # Always use CPU for inference to avoid device issues
+        # This is more reliable across different environments
+        batch = torch.stack(image_tensors).cpu()
         
-        Args:
-            embedding1: First embedding
-            embedding2: Second embedding
+        # Generate embeddings
+        with torch.inference_mode():
+            embeddings = self.model.cpu()(batch)
             
-        Returns:
-            float: Similarity score between 0 and 1
-        """
-        # Normalize embeddings
-        embedding1 = embedding1 / np.linalg.norm(embedding1)
-        embedding2 = embedding2 / np.linalg.norm(embedding2)
+        # Flatten and convert to numpy
+        embeddings = embeddings.reshape(len(image_tensors), -1).numpy()
         
-        # Calculate cosine similarity
-        similarity = np.dot(embedding1, embedding2)
+        # Normalize the embeddings once here, so similarity search is a bare dot product
+        embeddings = embeddings / (np.linalg.norm(embeddings, axis=1, keepdims=True) + 1e-12)
         
-        return float(similarity)
+        # Convert to bytes for storage (raw little-endian float16)
+        return [embedding.tobytes() for embedding in embeddings.astype(EMBEDDING_DTYPE)]
+    
+    @staticmethod
+    def embedding_from_bytes(embedding_bytes: bytes) -> np.ndarray:
+        """Convert stored embedding bytes back to a float32 numpy array."""
+        return np.frombuffer(embedding_bytes, dtype=EMBEDDING_DTYPE).astype(np.float32)
+    
+    @staticmethod
+    def embeddings_from_bytes(embeddings_bytes: List[bytes]) -> np.ndarray:
+        """Decode many stored embeddings at once into an (N, D) matrix."""
+        if not embeddings_bytes:
+            return np.empty((0, 0), dtype=np.float32)
+        embeddings = np.frombuffer(b"".join(embeddings_bytes), dtype=EMBEDDING_DTYPE).astype(np.float32)
+        return embeddings.reshape(len(embeddings_bytes), -1)
 
 
-# Singleton instance
+class EmbeddingBatcher:
+    """
+    Coalesces embeddings requested by concurrent uploads into one model forward
+    pass. Images are decoded by each caller in a worker thread; the batch runs
+    once it is full or a short window has passed.
+    """
+    
+    def __init__(self, service: EmbeddingService, batch_size: int, window_seconds: float):
+        self.service = service
+        self.batch_size = batch_size
+        self.window_seconds = window_seconds
+        self._pending: list = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+    
+    async def create_embedding(self, image_file: BinaryIO) -> bytes:
+        """Same as EmbeddingService.create_embedding(), batched with concurrent calls."""
+        loop = asyncio.get_running_loop()
+        image_tensor = await loop.run_in_executor(None, self.service.preprocess, image_file)
+        future = loop.create_future()
+        self._pending.append((image_tensor, future))
+        if len(self._pending) >= self.batch_size:
+            self._start()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window_seconds, self._start)
+        return await future
+    
+    def _start(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        requests, self._pending = self._pending, []
+        task = asyncio.ensure_future(self._run(requests))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _run(self, requests: list) -> None:
+        image_tensors = [image_tensor for image_tensor, _ in requests]
+        futures = [future for _, future in requests]
+        try:
+            embeddings = await asyncio.get_running_loop().run_in_executor(
+                None, self.service.embed_batch, image_tensors
+            )
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, embedding in zip(futures, embeddings):
+            # Skip callers that went away (request cancelled)
+            if not future.done():
+                future.set_result(embedding)
+
+
+# Singleton instances
 _embedding_service = None
+_embedding_batcher = None
 
 
 def get_embedding_service() -> EmbeddingService:
@@ -102,3 +160,16 @@ def get_embedding_service() -> EmbeddingService:
     if _embedding_service is None:
         _embedding_service = EmbeddingService()
     return _embedding_service
+
+
+def get_embedding_batcher() -> EmbeddingBatcher:
+    """Get or create the embedding batcher singleton."""
+    global _embedding_batcher
+    if _embedding_batcher is None:
+        settings = get_settings()
+        _embedding_batcher = EmbeddingBatcher(
+            get_embedding_service(),
+            settings.embedding_batch_size,
+            settings.embedding_batch_window_ms / 1000
+        )
+    return _embedding_batcher
@@ -0,0 +1,88 @@
+"""
+On-disk cache of image embeddings keyed by a hash of the uploaded file's bytes,
+so re-uploading an identical image skips the model forward pass.
+Entries are also keyed by the storage dtype, so a format change never serves
+embeddings encoded the old way. The cache is bounded: once it holds more than
+the configured number of entries, the least recently used ones are evicted.
+"""
+import os
+import uuid
+from typing import Optional
+
+from app.embedding import EMBEDDING_DTYPE
+from app.image_cache import ensure_dir
+
+CACHE_DIR_NAME = ".embeddings"
+
+# Writes between two size checks, so uploads don't list the cache directory every time
+PRUNE_INTERVAL = 100
+
+# Start at the interval so the first write after a restart checks the size
+_writes_since_prune = PRUNE_INTERVAL
+
+
+def get_cache_path(upload_dir: str, content_hash: str) -> str:
+    """Build the cache file path for the embedding of an image with the given content hash."""
+    cache_dir = ensure_dir(os.path.join(upload_dir, CACHE_DIR_NAME))
+    return os.path.join(cache_dir, f"{content_hash}-{EMBEDDING_DTYPE.name}.bin")
+
+
+def read_cached_embedding(upload_dir: str, content_hash: str) -> Optional[bytes]:
+    """Return the cached embedding bytes for an image, or None if not cached."""
+    cache_path = get_cache_path(upload_dir, content_hash)
+    try:
+        with open(cache_path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    # Mark the entry as recently used so eviction keeps it
+    try:
+        os.utime(cache_path)
+    except OSError:
+        pass
+    return data
+
+
+def prune_cache(upload_dir: str, max_entries: int) -> None:
+    """Evict the least recently used entries until at most max_entries remain."""
+    cache_dir = ensure_dir(os.path.join(upload_dir, CACHE_DIR_NAME))
+    entries = []
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if entry.name.endswith(".bin"):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    pass
+    if len(entries) <= max_entries:
+        return
+    entries.sort()
+    for _, path in entries[:len(entries) - max_entries]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def write_cached_embedding(upload_dir: str, content_hash: str, embedding_bytes: bytes) -> bool:
+    """
+    Atomically store the embedding bytes for an image.
+    Returns True when enough writes have accumulated that the cache should be pruned.
+    """
+    global _writes_since_prune
+    cache_path = get_cache_path(upload_dir, content_hash)
+    tmp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(embedding_bytes)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    
+    _writes_since_prune += 1
+    if _writes_since_prune >= PRUNE_INTERVAL:
+        _writes_since_prune = 0
+        return True
+    return False
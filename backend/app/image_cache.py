@@ -0,0 +1,83 @@
+"""
+On-disk cache for re-encoded sock images (thumbnails and quality variants).
+Entries are keyed by (sock_id, source mtime, size, quality) so a changed source
+file never serves a stale variant.
+"""
+import glob
+import os
+import uuid
+from typing import List
+
+from app.logging_config import setup_logging, log_error
+
+logger = setup_logging(service_name="image_cache", level="INFO")
+
+CACHE_DIR_NAME = ".thumbs"
+
+# Cache directories already created by this process, so requests skip the mkdir syscall
+_created_dirs = set()
+
+
+def ensure_dir(path: str) -> str:
+    """Create a directory once per process and return its path."""
+    if path not in _created_dirs:
+        os.makedirs(path, exist_ok=True)
+        _created_dirs.add(path)
+    return path
+
+
+def get_cache_dir(upload_dir: str) -> str:
+    """Return the cache directory inside the upload directory, creating it if needed."""
+    return ensure_dir(os.path.join(upload_dir, CACHE_DIR_NAME))
+
+
+def get_cache_path(upload_dir: str, sock_id: int, mtime: float, thumbnail: bool, quality: int) -> str:
+    """Build the cache file path for a specific image variant."""
+    size = 600 if thumbnail else "full"
+    return os.path.join(get_cache_dir(upload_dir), f"{sock_id}-{int(mtime)}-{size}-{quality}.jpg")
+
+
+def write_cache_entry(cache_path: str, data: bytes) -> None:
+    """
+    Atomically write an encoded image to the cache.
+    Entries for the same sock with an older source mtime are purged lazily here.
+    """
+    tmp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, cache_path)
+
+    # Drop variants generated from a previous version of the source image
+    cache_dir, filename = os.path.split(cache_path)
+    sock_id, mtime = filename.split("-")[:2]
+    for path in glob.glob(os.path.join(cache_dir, f"{sock_id}-*.jpg")):
+        if os.path.basename(path).split("-")[1] != mtime:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def purge_sock_cache(upload_dir: str, sock_id: int) -> None:
+    """Remove all cached variants for a sock (e.g. when the sock is deleted)."""
+    cache_dir = os.path.join(upload_dir, CACHE_DIR_NAME)
+    for path in glob.glob(os.path.join(cache_dir, f"{sock_id}-*.jpg")):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def remove_sock_files(upload_dir: str, sock_id: int, paths: List[str]) -> None:
+    """Remove the image files and cached variants of a deleted sock, logging (not raising) failures."""
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log_error(logger, "Failed to delete image file", exc=e,
+                sock_id=sock_id,
+                image_path=path,
+                event="image_delete_error")
+    purge_sock_cache(upload_dir, sock_id)
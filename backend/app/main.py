@@ -11,6 +11,7 @@ from opentelemetry.instrumentation.requests import RequestsInstrumentor
 import time
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.requests import Request
+from PIL import features as pil_features
 from app.database import engine, Base
 from app.routers import auth, singles, matches
 from app.config import get_settings
@@ -38,6 +39,12 @@ if settings.enable_tracing:
     
     logger.info(f"OpenTelemetry tracing enabled, sending to {settings.otlp_endpoint}")
 
+# Image resize/encode is the hot path for thumbnails, warn if the SIMD JPEG codec is missing
+if pil_features.check_feature("libjpeg_turbo"):
+    logger.info("Pillow is using libjpeg-turbo for JPEG encode/decode")
+else:
+    logger.warning("Pillow is not linked against libjpeg-turbo, JPEG thumbnails will be slower")
+
 
 # Create database tables
 Base.metadata.create_all(bind=engine)
@@ -122,6 +129,13 @@ if settings.enable_tracing:
     SQLAlchemyInstrumentor().instrument(engine=engine)
     RequestsInstrumentor().instrument()
 
+@app.on_event("shutdown")
+def shutdown_background_workers():
+    """Send any queued background removals, then stop the worker processes."""
+    singles.background_batcher.flush()
+    singles.shutdown_background_pool()
+
+
 @app.get("/")
 def root():
     """Root endpoint."""
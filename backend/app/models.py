@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, LargeBinary, Boolean, DateTime
+from sqlalchemy import Column, Integer, String, ForeignKey, LargeBinary, Boolean, DateTime, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from app.database import Base
@@ -20,6 +20,12 @@ class User(Base):
     privacy_accepted_at = Column(DateTime, nullable=True)
     privacy_version = Column(String, nullable=True)  # e.g., "1.0"
     
+    # Last user_sequence_id handed out to this user's socks (incremented atomically on upload)
+    next_sock_seq = Column(Integer, nullable=False, default=0, server_default="0")
+    # Bumped in the same transaction as every change to the user's unmatched socks, so each
+    # API process can tell whether its in-memory search index is stale
+    sock_set_version = Column(Integer, nullable=False, default=0, server_default="0")
+    
     socks = relationship("Sock", back_populates="owner")
 
 
@@ -31,6 +37,7 @@ class Sock(Base):
     user_sequence_id = Column(Integer, nullable=False)  # Sequential ID per user (1, 2, 3...)
     image_path = Column(String, nullable=False)
     image_no_bg_path = Column(String, nullable=True)  # Path to image with background removed
+    thumbnail_path = Column(String, nullable=True)  # Path to precomputed 600px JPEG thumbnail
     color_palette = Column(String, nullable=True)  # JSON array of hex color codes
     embedding = Column(LargeBinary, nullable=False)  # Stored as bytes
     is_matched = Column(Boolean, default=False)
@@ -40,6 +47,11 @@ class Sock(Base):
     # Relationships for matches
     matches_as_sock1 = relationship("Match", foreign_keys="Match.sock1_id", back_populates="sock1")
     matches_as_sock2 = relationship("Match", foreign_keys="Match.sock2_id", back_populates="sock2")
+    
+    __table_args__ = (
+        # Serves the per-user unmatched listing (newest first) and the similarity search candidate fetch
+        Index("ix_socks_owner_matched_created", owner_id, is_matched, created_at.desc()),
+    )
 
 
 class Match(Base):
@@ -1,57 +1,51 @@
+from typing import List
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy.orm import Session, aliased, contains_eager
+from sqlalchemy import func, delete
 from app.database import get_db
 from app.models import User, Sock, Match
 from app.schemas import MatchCreate, MatchResponse
 from app.auth import get_current_user
-from app.logging_config import setup_logging, log_with_context, log_error
+from app.embedding import EmbeddingService
+from app.config import get_settings
+from app.image_cache import remove_sock_files
+from app.sock_index import get_sock_index_service, bump_sock_set_version
+from app.logging_config import setup_logging, log_with_context
 
 router = APIRouter(prefix="/matches", tags=["matches"])
 logger = setup_logging(service_name="matches", level="INFO")
 
+# Small pool so the image files of a deleted match are unlinked in parallel
+_file_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="match-file-delete")
 
-@router.get("")
+
+@router.get("", response_model=List[MatchResponse])
 def get_matches(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     """Get all matches for the current user."""
-    from sqlalchemy.orm import joinedload
-    
-    # Get all matches and eagerly load the sock relationships
-    matches = db.query(Match).options(
-        joinedload(Match.sock1),
-        joinedload(Match.sock2)
+    sock1 = aliased(Sock)
+    sock2 = aliased(Sock)
+    # Only matches where both socks belong to the current user, filtered in SQL;
+    # the socks come from the same join, without their embeddings. FastAPI serializes
+    # the ORM objects straight to JSON through the MatchResponse schema.
+    matches = db.query(Match).join(sock1, Match.sock1).join(sock2, Match.sock2).filter(
+        sock1.owner_id == current_user.id,
+        sock2.owner_id == current_user.id
+    ).options(
+        contains_eager(Match.sock1.of_type(sock1)).load_only(
+            sock1.id, sock1.user_sequence_id, sock1.image_path, sock1.is_matched, sock1.created_at,
+            sock1.color_palette
+        ),
+        contains_eager(Match.sock2.of_type(sock2)).load_only(
+            sock2.id, sock2.user_sequence_id, sock2.image_path, sock2.is_matched, sock2.created_at,
+            sock2.color_palette
+        )
     ).order_by(Match.matched_at.desc()).all()
     
-    # Filter to only include matches where both socks belong to current user
-    user_matches = []
-    for m in matches:
-        if m.sock1 and m.sock2 and m.sock1.owner_id == current_user.id and m.sock2.owner_id == current_user.id:
-            user_matches.append({
-                "id": m.id,
-                "user_sequence_id": m.user_sequence_id,
-                "sock1_id": m.sock1_id,
-                "sock2_id": m.sock2_id,
-                "matched_at": m.matched_at.isoformat(),
-                "sock1": {
-                    "id": m.sock1.id,
-                    "user_sequence_id": m.sock1.user_sequence_id,
-                    "image_path": m.sock1.image_path,
-                    "is_matched": m.sock1.is_matched,
-                    "created_at": m.sock1.created_at.isoformat()
-                },
-                "sock2": {
-                    "id": m.sock2.id,
-                    "user_sequence_id": m.sock2.user_sequence_id,
-                    "image_path": m.sock2.image_path,
-                    "is_matched": m.sock2.is_matched,
-                    "created_at": m.sock2.created_at.isoformat()
-                }
-            })
-    
-    return user_matches
+    return matches
 
 
 @router.get("/{match_id}", response_model=MatchResponse)
@@ -161,8 +155,10 @@ def create_match(
     sock2.is_matched = True
     
     db.add(new_match)
+    sock_set_version = bump_sock_set_version(db, current_user.id)
     db.commit()
     db.refresh(new_match)
+    get_sock_index_service().remove(current_user.id, sock_set_version, [sock1.id, sock2.id])
     # Ensure relationships are loaded
     _ = new_match.sock1
     _ = new_match.sock2
@@ -189,9 +185,6 @@ def delete_match(
     - If decouple=True: Break the match and mark both socks as unmatched (socks remain)
     - If decouple=False: Delete both socks and the match (default)
     """
-    import os
-    from app.config import get_settings
-    
     match = db.query(Match).filter(Match.id == match_id).first()
     
     if not match:
@@ -215,34 +208,38 @@ def delete_match(
         # Decouple: just break the match and mark socks as unmatched
         match.sock1.is_matched = False
         match.sock2.is_matched = False
+        socks = (match.sock1, match.sock2)
         db.delete(match)
+        sock_set_version = bump_sock_set_version(db, current_user.id)
         db.commit()
+        get_sock_index_service().add(
+            current_user.id,
+            sock_set_version,
+            [sock.id for sock in socks],
+            EmbeddingService.embeddings_from_bytes([sock.embedding for sock in socks])
+        )
         log_with_context(logger, "info", "Match decoupled successfully",
             user_id=current_user.id,
             match_id=match_id,
             event="match_decoupled")
     else:
         # Delete both socks and the match
-        sock1 = match.sock1
-        sock2 = match.sock2
+        socks = [match.sock1, match.sock2]
+        sock_files = {
+            sock.id: [path for path in (sock.image_path, sock.image_no_bg_path, sock.thumbnail_path) if path]
+            for sock in socks
+        }
         
-        # Delete image files
-        for sock in [sock1, sock2]:
-            if os.path.exists(sock.image_path):
-                try:
-                    os.remove(sock.image_path)
-                except Exception as e:
-                    log_error(logger, "Failed to delete image file", exc=e,
-                        sock_id=sock.id,
-                        image_path=sock.image_path,
-                        event="image_delete_error")
-        
-        # Delete the match first (due to foreign key constraints)
-        db.delete(match)
-        # Then delete the socks
-        db.delete(sock1)
-        db.delete(sock2)
+        # Bulk delete: the match first (due to foreign key constraints), then both socks
+        db.execute(delete(Match).where(Match.id == match_id))
+        db.execute(delete(Sock).where(Sock.id.in_(list(sock_files))))
         db.commit()
+        
+        # Delete image files once the rows are gone, one sock per worker
+        futures = [_file_pool.submit(remove_sock_files, get_settings().upload_dir, sock_id, paths) for sock_id, paths in sock_files.items()]
+        for future in futures:
+            future.result()
+        
         log_with_context(logger, "info", "Match and socks deleted successfully",
             user_id=current_user.id,
             match_id=match_id,
@@ -3,23 +3,33 @@ import uuid
 import hashlib
 import json
 import time
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
-from typing import List, Optional
-from collections import Counter
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Query, Header, BackgroundTasks
+from typing import BinaryIO, List, Optional, Tuple
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status, UploadFile, File, Query, Header
 from fastapi.responses import FileResponse, Response
-from sqlalchemy.orm import Session
-from sqlalchemy import func
-from PIL import Image
-from rembg import remove
-from sklearn.cluster import KMeans
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session, load_only
+from sqlalchemy import update
+from PIL import Image, ImageOps
+import onnxruntime as ort
+from rembg import remove, new_session
+from rembg.sessions.u2net import U2netSession
+from rembg.sessions.u2netp import U2netpSession
+from sklearn.cluster import MiniBatchKMeans
 import numpy as np
-from app.database import get_db
+from app.database import get_db, SessionLocal
 from app.models import User, Sock, Match
 from app.schemas import SockResponse, SockMatch, MatchCreate, MatchResponse
-from app.auth import get_current_user
-from app.embedding import get_embedding_service, EmbeddingService
+from app.auth import get_current_user, get_email_from_token
+from app.embedding import get_embedding_service, get_embedding_batcher, EmbeddingService
+from app.sock_index import get_sock_index_service, get_search_batcher, bump_sock_set_version, SockIndexService
 from app.config import get_settings
+from app.image_cache import get_cache_path, write_cache_entry, purge_sock_cache, remove_sock_files
+from app.embedding_cache import read_cached_embedding, write_cached_embedding, prune_cache
 from app.logging_config import setup_logging, log_with_context, log_error
 
 router = APIRouter(prefix="/singles", tags=["singles"])
@@ -29,6 +39,42 @@ logger = setup_logging(service_name="singles", level="INFO")
 # Ensure upload directory exists
 os.makedirs(settings.upload_dir, exist_ok=True)
 
+# Uploads are read in chunks of this size so the size cap is enforced early
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Maximum number of pixels clustered when extracting a color palette
+PALETTE_SAMPLE_SIZE = 10000
+
+# Sock images are only served to their owner: let the browser cache them for a day,
+# but keep shared caches/proxies from storing them
+IMAGE_CACHE_CONTROL = "private, max-age=86400, immutable"
+
+# Two-digit hex strings for 0-255, used to format palette colors
+HEX_BYTE = [f"{i:02x}" for i in range(256)]
+
+# JPEG quality of the thumbnail precomputed after upload (the image endpoint's default)
+THUMBNAIL_QUALITY = 85
+
+
+def _select_diverse_colors(colors: np.ndarray, candidates: np.ndarray, num_colors: int, min_distance: float) -> List[int]:
+    """
+    Greedily pick up to num_colors candidates, in order, that are at least
+    min_distance apart from every color picked before them.
+    """
+    # All pairwise squared distances at once (at most 15x15), compared without sqrt
+    diffs = colors[:, None, :] - colors[None, :, :]
+    too_close = (diffs ** 2).sum(axis=2) < min_distance ** 2
+    
+    selected = []
+    for index in candidates:
+        # Stop if we have enough colors
+        if len(selected) >= num_colors:
+            break
+        # Check if this color is sufficiently different from already selected colors
+        if not too_close[index, selected].any():
+            selected.append(int(index))
+    return selected
+
 
 def extract_color_palette(image: Image.Image, num_colors: int = 5) -> List[str]:
     """
@@ -39,172 +85,477 @@ def extract_color_palette(image: Image.Image, num_colors: int = 5) -> List[str]:
     try:
         # Convert to RGB if needed (handling RGBA)
         if image.mode == 'RGBA':
-            # Get only non-transparent pixels
-            pixels = []
-            for x in range(image.width):
-                for y in range(image.height):
-                    pixel = image.getpixel((x, y))
-                    # Only include pixels with significant alpha (not transparent)
-                    if pixel[3] > 128:  # Alpha channel > 128 (50% opacity)
-                        pixels.append(pixel[:3])  # Take only RGB, ignore alpha
+            # Get only non-transparent pixels (alpha > 128, i.e. 50% opacity), RGB only
+            rgba = np.asarray(image, dtype=np.uint8)
+            pixels_array = rgba[rgba[..., 3] > 128][:, :3]
             
-            if not pixels:
+            if pixels_array.size == 0:
                 return []
-            
-            # Convert to numpy array
-            pixels_array = np.array(pixels)
         else:
             # If not RGBA, convert to RGB
             image_rgb = image.convert('RGB')
             pixels_array = np.array(image_rgb).reshape(-1, 3)
         
+        # Dominant colors don't depend on resolution: cluster a fixed-size random sample
+        if len(pixels_array) > PALETTE_SAMPLE_SIZE:
+            rng = np.random.default_rng(42)
+            pixels_array = pixels_array[rng.choice(len(pixels_array), size=PALETTE_SAMPLE_SIZE, replace=False)]
+        
         # Extract more colors initially to capture accent colors
         initial_colors = min(15, len(pixels_array))
         if len(pixels_array) < initial_colors:
             initial_colors = max(1, len(pixels_array))
         
-        kmeans = KMeans(n_clusters=initial_colors, random_state=42, n_init=10)
+        # A single mini-batch run is plenty for color quantization
+        kmeans = MiniBatchKMeans(
+            n_clusters=initial_colors,
+            init='k-means++',
+            n_init=1,
+            batch_size=1024,
+            max_iter=50,
+            random_state=42
+        )
         kmeans.fit(pixels_array)
         
         # Get the colors with their frequencies
         colors = kmeans.cluster_centers_
-        labels = kmeans.labels_
-        label_counts = Counter(labels)
-        
-        def color_distance(c1, c2):
-            """Calculate Euclidean distance between two colors."""
-            return np.sqrt(np.sum((c1 - c2) ** 2))
+        frequencies = np.bincount(kmeans.labels_, minlength=len(colors))
         
-        def color_saturation(color):
-            """Calculate color saturation (how vibrant/distinct it is)."""
-            r, g, b = color / 255.0
-            max_val = max(r, g, b)
-            min_val = min(r, g, b)
-            if max_val == 0:
-                return 0
-            return (max_val - min_val) / max_val
+        # Color saturation (how vibrant/distinct each color is)
+        max_vals = colors.max(axis=1)
+        saturations = (max_vals - colors.min(axis=1)) / np.maximum(max_vals, 1e-9)
         
-        # Create list of colors with metadata
-        color_data = []
-        for i in range(len(colors)):
-            color = colors[i]
-            frequency = label_counts[i]
-            saturation = color_saturation(color)
-            # Score combines frequency and saturation to capture both common and vibrant colors
-            # Boost saturation importance to catch accent colors
-            score = (frequency ** 0.7) * (1 + saturation * 2)
-            color_data.append({
-                'color': color,
-                'frequency': frequency,
-                'saturation': saturation,
-                'score': score
-            })
+        # Score combines frequency and saturation to capture both common and vibrant colors
+        # Boost saturation importance to catch accent colors
+        scores = (frequencies ** 0.7) * (1 + saturations * 2)
         
         # Sort by score (balances frequency and distinctiveness)
-        color_data.sort(key=lambda x: x['score'], reverse=True)
+        order = np.argsort(-scores, kind='stable')
         
-        # Ensure highly saturated colors (accent colors) are prioritized
-        # Separate high saturation colors and prioritize them
-        high_sat_colors = [d for d in color_data if d['saturation'] > 0.4]
-        low_sat_colors = [d for d in color_data if d['saturation'] <= 0.4]
+        # Ensure highly saturated colors (accent colors) are prioritized:
+        # high saturation colors first, then less saturated (base) colors, each by score
+        high_sat = order[saturations[order] > 0.4]
+        low_sat = order[saturations[order] <= 0.4]
         
         # Select diverse colors - avoid very similar colors
-        selected_colors = []
         min_distance = 30  # Reduced threshold to allow more color variation
+        selected = _select_diverse_colors(colors, np.concatenate([high_sat, low_sat]), num_colors, min_distance)
+        selected_colors = colors[selected]
         
-        # First pass: Add high saturation (vibrant) colors to ensure accent colors are included
-        for data in high_sat_colors:
-            color = data['color']
-            # Check if this color is sufficiently different from already selected colors
-            is_distinct = True
-            for selected in selected_colors:
-                if color_distance(color, selected) < min_distance:
-                    is_distinct = False
-                    break
-            
-            if is_distinct:
-                selected_colors.append(color)
-            
-            # Stop if we have enough colors
-            if len(selected_colors) >= num_colors:
-                break
-        
-        # Second pass: Fill remaining slots with less saturated (base) colors
-        for data in low_sat_colors:
-            if len(selected_colors) >= num_colors:
-                break
-                
-            color = data['color']
-            # Check if this color is sufficiently different from already selected colors
-            is_distinct = True
-            for selected in selected_colors:
-                if color_distance(color, selected) < min_distance:
-                    is_distinct = False
-                    break
-            
-            if is_distinct:
-                selected_colors.append(color)
-        
-        # Convert to hex codes
-        hex_colors = []
-        for color in selected_colors:
-            r, g, b = color.astype(int)
-            hex_color = f"#{r:02x}{g:02x}{b:02x}"
-            hex_colors.append(hex_color)
-        
-        return hex_colors
+        # Convert to hex codes via a lookup table (truncate like int(), as before)
+        rgb = np.clip(selected_colors.astype(int), 0, 255).tolist()
+        return ["#" + HEX_BYTE[r] + HEX_BYTE[g] + HEX_BYTE[b] for r, g, b in rgb]
     except Exception as e:
         print(f"Failed to extract color palette: {str(e)}")
         return []
 
 
-def process_background_removal(sock_id: int, file_path: str, upload_dir: str):
-    """Background task to remove background from uploaded sock image."""
-    start_time = time.time()
+def _reject_too_large(user_id: int, filename: Optional[str]) -> None:
+    """Log and raise a 413 for an upload exceeding the configured size cap."""
+    log_with_context(logger, "warning", "Upload too large", 
+        user_id=user_id, 
+        filename=filename,
+        max_upload_bytes=settings.max_upload_bytes,
+        event="upload_failed", 
+        reason="too_large")
+    raise HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"File too large (max {settings.max_upload_bytes // (1024 * 1024)} MB)"
+    )
+
+
+def _save_upload(source: BinaryIO, path: str, max_bytes: int) -> Optional[str]:
+    """
+    Copy an upload to a new file in chunks (blocking, meant to run in the threadpool).
+    Returns a hash of the file's content, or None, leaving a partial file behind,
+    if it is larger than max_bytes.
+    """
+    content_hash = hashlib.blake2b(digest_size=16)
+    written = 0
+    with open(path, "wb") as out:
+        while chunk := source.read(UPLOAD_CHUNK_SIZE):
+            written += len(chunk)
+            if written > max_bytes:
+                return None
+            out.write(chunk)
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+def _discard_file(path: str) -> None:
+    """Remove a file if it exists (blocking, meant to run in the threadpool)."""
     try:
-        # Generate filename for background-removed version
-        unique_filename_no_bg = f"{uuid.uuid4()}_no_bg.png"
-        file_path_no_bg = os.path.join(upload_dir, unique_filename_no_bg)
-        
-        # Create background-removed version
-        with open(file_path, "rb") as img_file:
-            input_image = Image.open(img_file)
-            output_image = remove(input_image)
-            
-            # Crop the image to the bounding box of non-transparent pixels
-            bbox = output_image.getbbox()
-            if bbox:
-                output_image = output_image.crop(bbox)
-            
-            output_image.save(file_path_no_bg, "PNG")
-        
-        # Extract color palette from the background-removed image
-        color_palette = extract_color_palette(output_image, num_colors=5)
-        color_palette_json = json.dumps(color_palette) if color_palette else None
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def encode_jpeg(img: Image.Image, thumbnail: bool, quality: int) -> bytes:
+    """Encode an image as JPEG, optionally downscaled to a thumbnail (max 600px)."""
+    # Convert to RGB if needed (for JPEG compatibility)
+    if img.mode in ('RGBA', 'LA', 'P'):
+        rgb_img = Image.new('RGB', img.size, (255, 255, 255))
+        if img.mode == 'P':
+            img = img.convert('RGBA')
+        rgb_img.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
+        img = rgb_img
+    
+    # Resize for thumbnail: cheap integer box-filter reduction first,
+    # then a bilinear pass for the remaining (< 2x) non-integer step
+    if thumbnail:
+        factor = max(img.size) // 600
+        if factor > 1:
+            img = img.reduce(factor)
+        img.thumbnail((600, 600), Image.Resampling.BILINEAR)
+    
+    # Save to bytes with quality setting
+    output = BytesIO()
+    img.save(output, format='JPEG', quality=quality, optimize=True)
+    return output.getvalue()
+
+
+# U2-Net's expected input: ImageNet-normalized RGB at 320x320
+U2NET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+U2NET_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+U2NET_INPUT_SIZE = (320, 320)
+
+# Stock U2-Net models, run directly with onnxruntime so a batch of uploads shares one inference call
+U2NET_SESSIONS = {"u2net": U2netSession, "u2netp": U2netpSession}
+
+
+class U2NetRemover:
+    """
+    Background removal with a U2-Net ONNX export, equivalent to rembg's remove()
+    with the default naive cutout.
+    """
+    
+    def __init__(self, model_path: str, providers: List[str]):
+        self.session = ort.InferenceSession(model_path, providers=providers)
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        # A symbolic batch dimension accepts any batch size; exports fixed at one get a call per image
+        self.batched = not isinstance(model_input.shape[0], int)
+    
+    def _preprocess(self, img: Image.Image) -> np.ndarray:
+        pixels = np.asarray(img.convert("RGB").resize(U2NET_INPUT_SIZE, Image.Resampling.LANCZOS), dtype=np.float32)
+        pixels = (pixels / max(pixels.max(), 1e-6) - U2NET_MEAN) / U2NET_STD
+        return pixels.transpose(2, 0, 1)[np.newaxis]
+    
+    def _predict(self, batch: np.ndarray) -> np.ndarray:
+        return self.session.run(None, {self.input_name: batch})[0][:, 0, :, :]
+    
+    def remove(self, images: List[Image.Image]) -> List[Image.Image]:
+        images = [ImageOps.exif_transpose(img) for img in images]
+        inputs = [self._preprocess(img) for img in images]
+        if self.batched:
+            preds = self._predict(np.concatenate(inputs))
+        else:
+            preds = np.concatenate([self._predict(x) for x in inputs])
         
-        # Update the database with the background-removed image path and color palette
-        from app.database import SessionLocal
-        db = SessionLocal()
+        cutouts = []
+        for img, pred in zip(images, preds):
+            # Normalize each mask on its own, like a single-image call would
+            mi, ma = np.min(pred), np.max(pred)
+            pred = (pred - mi) / (ma - mi)
+            mask = Image.fromarray((pred.clip(0, 1) * 255).astype("uint8"), mode="L")
+            mask = mask.resize(img.size, Image.Resampling.LANCZOS)
+            cutouts.append(Image.composite(img, Image.new("RGBA", img.size, 0), mask))
+        return cutouts
+
+
+class RembgRemover:
+    """Background removal through rembg, one image at a time (for non-U2-Net models)."""
+    
+    def __init__(self, model_name: str, providers: List[str]):
+        self.session = new_session(model_name, providers=providers)
+    
+    def remove(self, images: List[Image.Image]) -> List[Image.Image]:
+        return [remove(img, session=self.session) for img in images]
+
+
+# Singleton background remover (loading the model weights is expensive, do it once per process)
+_background_remover = None
+
+
+def get_background_remover():
+    """Get or create the background remover, preferring CUDA when onnxruntime supports it."""
+    global _background_remover
+    if _background_remover is None:
+        available = ort.get_available_providers()
+        providers = [p for p in ("CUDAExecutionProvider", "CPUExecutionProvider") if p in available]
+        if settings.rembg_model_path:
+            _background_remover = U2NetRemover(settings.rembg_model_path, providers)
+        elif settings.rembg_model in U2NET_SESSIONS:
+            _background_remover = U2NetRemover(str(U2NET_SESSIONS[settings.rembg_model].download_models()), providers)
+        else:
+            _background_remover = RembgRemover(settings.rembg_model, providers)
+    return _background_remover
+
+
+def _init_background_worker():
+    """Load the background removal model once when a worker process starts."""
+    try:
+        get_background_remover()
+    except Exception as e:
+        # Leave the worker alive, the task itself will retry and log the failure
+        log_error(logger, "Loading background removal model failed", exc=e, event="rembg_session_error")
+
+
+# Background removal runs in dedicated worker processes, so ONNX inference never
+# competes with request handling for the API worker's GIL
+_background_pool = None
+# Timer threads, the event loop and pool done callbacks all create or replace the pool
+_background_pool_lock = threading.Lock()
+
+
+def get_background_pool() -> ProcessPoolExecutor:
+    """Get or create the background removal process pool."""
+    global _background_pool
+    with _background_pool_lock:
+        if _background_pool is None:
+            _background_pool = ProcessPoolExecutor(
+                max_workers=settings.background_workers,
+                # spawn: don't fork the API process with its DB connections and ONNX/torch threads
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_background_worker
+            )
+        return _background_pool
+
+
+def shutdown_background_pool() -> None:
+    """Stop the background removal workers, letting queued tasks finish."""
+    global _background_pool
+    with _background_pool_lock:
+        pool, _background_pool = _background_pool, None
+    # Outside the lock: done callbacks running during shutdown may need it
+    if pool is not None:
+        pool.shutdown(wait=True)
+
+
+def _reset_background_pool(pool: ProcessPoolExecutor) -> None:
+    """Drop a broken pool so the next submit starts fresh workers."""
+    global _background_pool
+    with _background_pool_lock:
+        if _background_pool is pool:
+            _background_pool = None
+    pool.shutdown(wait=False)
+
+
+# Palette extraction overlaps with the PNG encode/write (both release the GIL for most of their work)
+_palette_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="palette")
+
+
+def process_background_removal(tasks: List[Tuple[int, str]], upload_dir: str):
+    """Background task to remove the background from a batch of uploaded sock images."""
+    start_time = time.time()
+    
+    # Load the images, skipping (and logging) the ones that can't be read
+    loaded = []
+    for sock_id, file_path in tasks:
         try:
-            sock = db.query(Sock).filter(Sock.id == sock_id).first()
-            if sock:
+            with Image.open(file_path) as img:
+                img.load()
+            loaded.append((sock_id, img))
+        except Exception as e:
+            log_error(logger, "Background removal failed", exc=e, 
+                sock_id=sock_id, 
+                event="background_removal_error")
+    if not loaded:
+        return
+    
+    try:
+        output_images = get_background_remover().remove([img for _, img in loaded])
+    except Exception as e:
+        duration_ms = (time.time() - start_time) * 1000
+        for sock_id, _ in loaded:
+            log_error(logger, "Background removal failed", exc=e, 
+                sock_id=sock_id, 
+                duration_ms=round(duration_ms, 2),
+                event="background_removal_error")
+        return
+    
+    db = SessionLocal()
+    try:
+        for (sock_id, input_image), output_image in zip(loaded, output_images):
+            thumbnail_path = None
+            file_path_no_bg = None
+            try:
+                # Skip socks deleted while queued, before writing any files for them
+                sock = db.query(Sock).filter(Sock.id == sock_id).first()
+                if not sock:
+                    log_with_context(logger, "info", "Sock deleted before background removal, skipping",
+                        sock_id=sock_id,
+                        event="background_removal_skipped")
+                    continue
+                
+                # Precompute the default thumbnail so the image endpoint doesn't resize on request
+                try:
+                    thumbnail_path = os.path.join(upload_dir, f"{uuid.uuid4()}_thumb.jpg")
+                    with open(thumbnail_path, "wb") as f:
+                        f.write(encode_jpeg(input_image, thumbnail=True, quality=THUMBNAIL_QUALITY))
+                except Exception as e:
+                    log_error(logger, "Thumbnail generation failed", exc=e,
+                        sock_id=sock_id,
+                        event="thumbnail_error")
+                    if thumbnail_path and os.path.exists(thumbnail_path):
+                        os.remove(thumbnail_path)
+                    thumbnail_path = None
+                
+                # Generate filename for background-removed version
+                unique_filename_no_bg = f"{uuid.uuid4()}_no_bg.png"
+                file_path_no_bg = os.path.join(upload_dir, unique_filename_no_bg)
+                
+                # Crop the image to the bounding box of non-transparent pixels
+                bbox = output_image.getbbox()
+                if bbox:
+                    output_image = output_image.crop(bbox)
+                
+                # Extract color palette from the background-removed image while the PNG is written
+                palette_future = _palette_pool.submit(extract_color_palette, output_image, 5)
+                output_image.save(file_path_no_bg, "PNG")
+                color_palette = palette_future.result()
+                color_palette_json = json.dumps(color_palette) if color_palette else None
+                
+                # Update the database with the background-removed image path and color palette
+                # (fails if the sock was deleted in the meantime)
                 sock.image_no_bg_path = file_path_no_bg
+                sock.thumbnail_path = thumbnail_path
                 sock.color_palette = color_palette_json
                 db.commit()
                 duration_ms = (time.time() - start_time) * 1000
                 log_with_context(logger, "info", "Background removal completed", 
                     sock_id=sock_id, 
                     colors_found=len(color_palette) if color_palette else 0,
+                    batch_size=len(loaded),
                     duration_ms=round(duration_ms, 2),
                     event="background_removal_success")
-        finally:
-            db.close()
-    except Exception as e:
-        duration_ms = (time.time() - start_time) * 1000
-        log_error(logger, "Background removal failed", exc=e, 
-            sock_id=sock_id, 
-            duration_ms=round(duration_ms, 2),
-            event="background_removal_error")
+            except Exception as e:
+                db.rollback()
+                # No row references the new files, remove them instead of leaving orphans
+                for path in (thumbnail_path, file_path_no_bg):
+                    if path:
+                        _discard_file(path)
+                duration_ms = (time.time() - start_time) * 1000
+                log_error(logger, "Background removal failed", exc=e, 
+                    sock_id=sock_id, 
+                    duration_ms=round(duration_ms, 2),
+                    event="background_removal_error")
+    finally:
+        db.close()
+
+
+# Times a batch is resubmitted after its worker pool broke before it is dropped
+BACKGROUND_MAX_RETRIES = 2
+
+
+class BackgroundRemovalBatcher:
+    """
+    Collects background removal requests for a short window and hands them to
+    the worker pool together, so U2-Net runs once per batch instead of per image.
+    """
+    
+    def __init__(self, upload_dir: str, batch_size: int, window_seconds: float):
+        self.upload_dir = upload_dir
+        self.batch_size = batch_size
+        self.window_seconds = window_seconds
+        self._pending: List[Tuple[int, str]] = []
+        self._timer: Optional[threading.Timer] = None
+        self._lock = threading.Lock()
+    
+    def add(self, sock_id: int, file_path: str) -> None:
+        """Queue a sock; the batch is sent when it is full or the window expires."""
+        with self._lock:
+            self._pending.append((sock_id, file_path))
+            if len(self._pending) < self.batch_size:
+                if self._timer is None:
+                    self._timer = threading.Timer(self.window_seconds, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+            batch = self._take()
+        self._submit(batch)
+    
+    def flush(self) -> None:
+        """Send whatever is pending right away."""
+        with self._lock:
+            batch = self._take()
+        if batch:
+            self._submit(batch)
+    
+    def _take(self) -> List[Tuple[int, str]]:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        return batch
+    
+    def _submit(self, batch: List[Tuple[int, str]], attempt: int = 0) -> None:
+        pool = get_background_pool()
+        try:
+            future = pool.submit(process_background_removal, batch, self.upload_dir)
+        except Exception as e:
+            self._handle_failure(pool, batch, attempt, e)
+            return
+        future.add_done_callback(lambda f: self._on_done(pool, batch, attempt, f))
+    
+    def _on_done(self, pool: ProcessPoolExecutor, batch: List[Tuple[int, str]], attempt: int, future: Future) -> None:
+        if future.cancelled():
+            return
+        e = future.exception()
+        if e is not None:
+            self._handle_failure(pool, batch, attempt, e)
+    
+    def _handle_failure(self, pool: ProcessPoolExecutor, batch: List[Tuple[int, str]], attempt: int,
+                        e: BaseException) -> None:
+        # A crashed worker (often OOM-killed mid-inference) breaks the pool: retry the batch on
+        # fresh workers a few times. Inference never falls back to the API process itself.
+        retry = isinstance(e, BrokenProcessPool) and attempt < BACKGROUND_MAX_RETRIES
+        log_error(logger, "Background removal worker failed", exc=e,
+            sock_ids=[sock_id for sock_id, _ in batch],
+            attempt=attempt + 1,
+            retrying=retry,
+            event="background_removal_worker_error")
+        if isinstance(e, BrokenProcessPool):
+            _reset_background_pool(pool)
+        if retry:
+            self._submit(batch, attempt + 1)
+
+
+background_batcher = BackgroundRemovalBatcher(
+    settings.upload_dir,
+    batch_size=settings.background_batch_size,
+    window_seconds=settings.background_batch_window_ms / 1000
+)
+
+
+def _insert_sock(db: Session, owner_id: int, file_path: str, embedding_bytes: bytes) -> Tuple[Sock, int]:
+    """
+    Create the row for an uploaded sock (blocking, meant to run in the threadpool).
+    Returns the sock and the user's new sock set version.
+    """
+    # Get the next sequence ID for this user with a single atomic counter update, bumping
+    # the sock set version in the same statement (see bump_sock_set_version)
+    # (row lock on the user serializes concurrent uploads until commit)
+    next_sequence_id, sock_set_version = db.execute(
+        update(User)
+        .where(User.id == owner_id)
+        .values(next_sock_seq=User.next_sock_seq + 1, sock_set_version=User.sock_set_version + 1)
+        .returning(User.next_sock_seq, User.sock_set_version)
+    ).one()
+    
+    # Create sock record (without background-removed image initially)
+    new_sock = Sock(
+        owner_id=owner_id,
+        user_sequence_id=next_sequence_id,
+        image_path=file_path,
+        image_no_bg_path=None,  # Will be updated by background task
+        embedding=embedding_bytes
+    )
+    
+    db.add(new_sock)
+    db.commit()
+    db.refresh(new_sock)
+    return new_sock, sock_set_version
 
 
 @router.post("/upload", response_model=SockResponse, status_code=status.HTTP_201_CREATED)
@@ -240,20 +591,38 @@ async def upload_sock(
     unique_filename = f"{uuid.uuid4()}{file_extension}"
     file_path = os.path.join(settings.upload_dir, unique_filename)
     
-    # Save the file
-    with open(file_path, "wb") as buffer:
-        content = await file.read()
-        buffer.write(content)
+    # Reject oversized uploads before reading them: use the known size if available,
+    # otherwise enforce the cap while copying in chunks
+    if file.size is not None and file.size > settings.max_upload_bytes:
+        _reject_too_large(current_user.id, file.filename)
     
-    # Create embedding
+    # Stream the spooled upload to disk chunk by chunk (constant memory, in the threadpool)
     try:
-        # Reopen file for embedding creation
-        with open(file_path, "rb") as img_file:
-            embedding_bytes = embedding_service.create_embedding(img_file)
+        content_hash = await run_in_threadpool(_save_upload, file.file, file_path, settings.max_upload_bytes)
+    except Exception as e:
+        # Clean up the partial file
+        await run_in_threadpool(_discard_file, file_path)
+        log_error(logger, "Saving uploaded file failed", exc=e,
+            user_id=current_user.id,
+            filename=file.filename,
+            event="upload_write_error")
+        raise
+    if content_hash is None:
+        await run_in_threadpool(_discard_file, file_path)
+        _reject_too_large(current_user.id, file.filename)
+    
+    # Create the embedding (batched with concurrent uploads) straight from the spooled
+    # upload, so its bytes are never copied into memory as a whole. An identical image
+    # uploaded before reuses its cached embedding.
+    try:
+        embedding_bytes = await run_in_threadpool(read_cached_embedding, settings.upload_dir, content_hash)
+        cache_miss = embedding_bytes is None
+        if cache_miss:
+            await file.seek(0)
+            embedding_bytes = await get_embedding_batcher().create_embedding(file.file)
     except Exception as e:
         # Clean up file if embedding fails
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        await run_in_threadpool(_discard_file, file_path)
         log_error(logger, "Embedding creation failed", exc=e, 
             user_id=current_user.id, 
             filename=file.filename,
@@ -263,38 +632,35 @@ async def upload_sock(
             detail=f"Failed to create embedding: {str(e)}"
         )
     
-    # Get the next sequence ID for this user
-    max_sequence = db.query(func.max(Sock.user_sequence_id)).filter(
-        Sock.owner_id == current_user.id
-    ).scalar()
-    next_sequence_id = (max_sequence or 0) + 1
+    # Remember the embedding for identical re-uploads; a failed cache write must not fail the upload
+    if cache_miss:
+        try:
+            prune_due = await run_in_threadpool(write_cached_embedding, settings.upload_dir, content_hash, embedding_bytes)
+        except OSError as e:
+            log_error(logger, "Failed to cache embedding", exc=e,
+                user_id=current_user.id,
+                event="embedding_cache_write_error")
+        else:
+            if prune_due:
+                # Evict old entries after the response is sent
+                background_tasks.add_task(prune_cache, settings.upload_dir, settings.embedding_cache_max_entries)
     
-    # Create sock record (without background-removed image initially)
-    new_sock = Sock(
-        owner_id=current_user.id,
-        user_sequence_id=next_sequence_id,
-        image_path=file_path,
-        image_no_bg_path=None,  # Will be updated by background task
-        embedding=embedding_bytes
-    )
+    # Insert the sock row; the session is synchronous, so it runs in the threadpool
+    new_sock, sock_set_version = await run_in_threadpool(_insert_sock, db, current_user.id, file_path, embedding_bytes)
     
-    db.add(new_sock)
-    db.commit()
-    db.refresh(new_sock)
+    # Drop any cached variants left behind by a deleted sock that had the same id
+    await run_in_threadpool(purge_sock_cache, settings.upload_dir, new_sock.id)
+    get_sock_index_service().add(new_sock.owner_id, sock_set_version, [new_sock.id],
+        embedding_service.embeddings_from_bytes([embedding_bytes]))
     
-    # Schedule background removal as a background task
-    background_tasks.add_task(
-        process_background_removal,
-        new_sock.id,
-        file_path,
-        settings.upload_dir
-    )
+    # Queue background removal; it runs batched in the worker processes
+    background_batcher.add(new_sock.id, file_path)
     
     duration_ms = (time.time() - start_time) * 1000
     log_with_context(logger, "info", "Sock upload successful", 
-        user_id=current_user.id, 
+        user_id=new_sock.owner_id, 
         sock_id=new_sock.id,
-        user_sequence_id=next_sequence_id,
+        user_sequence_id=new_sock.user_sequence_id,
         duration_ms=round(duration_ms, 2),
         event="upload_success")
     
@@ -317,7 +683,16 @@ def list_unmatched_socks(
     db: Session = Depends(get_db)
 ):
     """List all unmatched socks for the current user."""
-    socks = db.query(Sock).filter(
+    # Skip the embedding blob, which the listing never needs
+    socks = db.query(Sock).options(load_only(
+        Sock.id,
+        Sock.user_sequence_id,
+        Sock.image_path,
+        Sock.is_matched,
+        Sock.created_at,
+        Sock.color_palette,
+        Sock.image_no_bg_path
+    )).filter(
         Sock.owner_id == current_user.id,
         Sock.is_matched == False
     ).order_by(Sock.created_at.desc()).all()
@@ -383,35 +758,62 @@ def get_sock(
     return response_dict
 
 
-@router.get("/{sock_id}/image")
-def get_sock_image(
+def _stat_file(path: Optional[str]) -> Optional[os.stat_result]:
+    """Stat a file with a single syscall, returning None if it doesn't exist."""
+    if not path:
+        return None
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
+
+def _not_modified_response(if_none_match: Optional[str], etag: str) -> Optional[Response]:
+    """Return a 304 response if the request's If-None-Match header covers the given ETag."""
+    if not if_none_match:
+        return None
+    
+    # The header may hold a comma-separated list of (possibly quoted or weak) tags, or "*"
+    tags = [tag.strip().removeprefix("W/").strip('"') for tag in if_none_match.split(",")]
+    if etag not in tags and "*" not in tags:
+        return None
+    
+    return Response(
+        status_code=status.HTTP_304_NOT_MODIFIED,
+        headers={
+            "Cache-Control": IMAGE_CACHE_CONTROL,
+            "ETag": etag,
+            "Access-Control-Allow-Origin": "*",
+        }
+    )
+
+
+def get_authorized_image_sock(
     sock_id: int,
     token: Optional[str] = Query(None),
     authorization: Optional[str] = Header(None),
-    thumbnail: bool = Query(False, description="Return a thumbnail version (max 600px)"),
-    quality: int = Query(85, ge=50, le=100, description="JPEG quality (50-100)"),
     db: Session = Depends(get_db)
-):
-    """Get the image file for a specific sock. Supports token via query param for web or Authorization header."""
-    from app.auth import get_user_from_token
-    
-    current_user = None
+) -> Sock:
+    """
+    Resolve the requesting user and the requested sock for the image endpoints.
+    Supports token via query param (for web img tags) or Authorization header (for mobile/API requests).
+    User and sock are fetched together in a single query.
+    """
+    if not token and authorization and authorization.startswith("Bearer "):
+        token = authorization.replace("Bearer ", "")
     
-    # Try query parameter token first (for web img tags)
-    if token:
-        current_user = get_user_from_token(token, db)
-    # Try Authorization header (for mobile/API requests)
-    elif authorization and authorization.startswith("Bearer "):
-        token_from_header = authorization.replace("Bearer ", "")
-        current_user = get_user_from_token(token_from_header, db)
+    email = get_email_from_token(token) if token else None
+    row = None
+    if email:
+        row = db.query(User, Sock).outerjoin(Sock, Sock.id == sock_id).filter(User.email == email).first()
     
-    if not current_user:
+    if not row:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Authentication required"
         )
     
-    sock = db.query(Sock).filter(Sock.id == sock_id).first()
+    current_user, sock = row
     
     if not sock:
         raise HTTPException(
@@ -426,130 +828,120 @@ def get_sock_image(
             detail="Not authorized to access this sock"
         )
     
-    # Check if file exists
-    if not os.path.exists(sock.image_path):
+    return sock
+
+
+@router.get("/{sock_id}/image")
+def get_sock_image(
+    sock_id: int,
+    thumbnail: bool = Query(False, description="Return a thumbnail version (max 600px)"),
+    quality: int = Query(85, ge=50, le=100, description="JPEG quality (50-100)"),
+    if_none_match: Optional[str] = Header(None),
+    sock: Sock = Depends(get_authorized_image_sock)
+):
+    """Get the image file for a specific sock. Supports token via query param for web or Authorization header."""
+    # Check if file exists (one stat gives both existence and mtime)
+    image_stat = _stat_file(sock.image_path)
+    if image_stat is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Image file not found"
         )
     
     # Generate ETag based on file modification time and parameters
-    file_mtime = os.path.getmtime(sock.image_path)
+    file_mtime = image_stat.st_mtime
     etag_base = f"{sock_id}-{file_mtime}-{thumbnail}-{quality}"
-    etag = hashlib.md5(etag_base.encode()).hexdigest()
+    etag = hashlib.blake2b(etag_base.encode(), digest_size=8).hexdigest()
+    
+    # Client already has this exact version cached, skip all image processing
+    not_modified = _not_modified_response(if_none_match, etag)
+    if not_modified:
+        return not_modified
+    
+    headers = {
+        "Cache-Control": IMAGE_CACHE_CONTROL,
+        "ETag": etag,
+        "Access-Control-Allow-Origin": "*",
+        "Access-Control-Allow-Methods": "GET",
+        "Access-Control-Allow-Headers": "*",
+    }
     
     # If thumbnail or quality adjustment requested, process image
     if thumbnail or quality < 100:
+        # Default thumbnails are precomputed after upload
+        if thumbnail and quality == THUMBNAIL_QUALITY:
+            thumbnail_stat = _stat_file(sock.thumbnail_path)
+            if thumbnail_stat is not None:
+                return FileResponse(sock.thumbnail_path, media_type="image/jpeg", headers=headers, stat_result=thumbnail_stat)
+        
+        # Serve a previously encoded variant straight from disk
+        cache_path = get_cache_path(settings.upload_dir, sock_id, file_mtime, thumbnail, quality)
+        cache_stat = _stat_file(cache_path)
+        if cache_stat is not None:
+            return FileResponse(cache_path, media_type="image/jpeg", headers=headers, stat_result=cache_stat)
+        
         try:
             with Image.open(sock.image_path) as img:
-                # Convert to RGB if needed (for JPEG compatibility)
-                if img.mode in ('RGBA', 'LA', 'P'):
-                    rgb_img = Image.new('RGB', img.size, (255, 255, 255))
-                    if img.mode == 'P':
-                        img = img.convert('RGBA')
-                    rgb_img.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
-                    img = rgb_img
-                
-                # Resize for thumbnail
+                # Let libjpeg downscale in the DCT domain while decoding (no-op for non-JPEG)
                 if thumbnail:
-                    img.thumbnail((600, 600), Image.Resampling.LANCZOS)
+                    img.draft('RGB', (600, 600))
                 
-                # Save to bytes with quality setting
-                output = BytesIO()
-                img.save(output, format='JPEG', quality=quality, optimize=True)
-                output.seek(0)
-                
-                return Response(
-                    content=output.read(),
-                    media_type="image/jpeg",
-                    headers={
-                        "Cache-Control": "public, max-age=86400, immutable",  # Cache for 1 day
-                        "ETag": etag,
-                        "Access-Control-Allow-Origin": "*",
-                        "Access-Control-Allow-Methods": "GET",
-                        "Access-Control-Allow-Headers": "*",
-                    }
-                )
+                content = encode_jpeg(img, thumbnail, quality)
+            
+            # Memoize the encoded variant; a failed cache write must not fail the request
+            try:
+                write_cache_entry(cache_path, content)
+            except OSError as e:
+                log_error(logger, "Failed to cache encoded image", exc=e,
+                    sock_id=sock_id,
+                    cache_path=cache_path,
+                    event="image_cache_write_error")
+            
+            return Response(content=content, media_type="image/jpeg", headers=headers)
         except Exception as e:
             print(f"Error processing image: {e}")
             # Fall back to original file
             pass
     
     # Return original file with cache headers
-    return FileResponse(
-        sock.image_path,
-        headers={
-            "Cache-Control": "public, max-age=86400, immutable",  # Cache for 1 day
-            "ETag": etag,
-            "Access-Control-Allow-Origin": "*",
-            "Access-Control-Allow-Methods": "GET",
-            "Access-Control-Allow-Headers": "*",
-        }
-    )
+    return FileResponse(sock.image_path, headers=headers, stat_result=image_stat)
 
 
 @router.get("/{sock_id}/image-no-bg")
 def get_sock_image_no_bg(
     sock_id: int,
-    token: Optional[str] = Query(None),
-    authorization: Optional[str] = Header(None),
-    db: Session = Depends(get_db)
+    if_none_match: Optional[str] = Header(None),
+    sock: Sock = Depends(get_authorized_image_sock)
 ):
     """Get the background-removed image file for a specific sock. Supports token via query param for web or Authorization header."""
-    from app.auth import get_user_from_token
-    
-    current_user = None
-    
-    # Try query parameter token first (for web img tags)
-    if token:
-        current_user = get_user_from_token(token, db)
-    # Try Authorization header (for mobile/API requests)
-    elif authorization and authorization.startswith("Bearer "):
-        token_from_header = authorization.replace("Bearer ", "")
-        current_user = get_user_from_token(token_from_header, db)
-    
-    if not current_user:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Authentication required"
-        )
-    
-    sock = db.query(Sock).filter(Sock.id == sock_id).first()
-    
-    if not sock:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Sock not found"
-        )
-    
-    # Verify ownership
-    if sock.owner_id != current_user.id:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Not authorized to access this sock"
-        )
-    
     # Check if background-removed file exists
-    if not sock.image_no_bg_path or not os.path.exists(sock.image_no_bg_path):
+    image_stat = _stat_file(sock.image_no_bg_path)
+    if image_stat is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Background-removed image file not found"
         )
     
     # Generate ETag based on file modification time
-    file_mtime = os.path.getmtime(sock.image_no_bg_path)
-    etag = hashlib.md5(f"{sock_id}-{file_mtime}".encode()).hexdigest()
+    file_mtime = image_stat.st_mtime
+    etag = hashlib.blake2b(f"{sock_id}-{file_mtime}".encode(), digest_size=8).hexdigest()
+    
+    # Client already has this exact version cached
+    not_modified = _not_modified_response(if_none_match, etag)
+    if not_modified:
+        return not_modified
     
     # Return file with cache headers and CORS headers for web compatibility
     return FileResponse(
         sock.image_no_bg_path,
         headers={
-            "Cache-Control": "public, max-age=86400, immutable",  # Cache for 1 day
+            "Cache-Control": IMAGE_CACHE_CONTROL,
             "ETag": etag,
             "Access-Control-Allow-Origin": "*",
             "Access-Control-Allow-Methods": "GET",
             "Access-Control-Allow-Headers": "*",
-        }
+        },
+        stat_result=image_stat
     )
 
 
@@ -559,12 +951,16 @@ async def search_by_sock_id(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db),
     embedding_service: EmbeddingService = Depends(get_embedding_service),
-    limit: int = 10
+    sock_index_service: SockIndexService = Depends(get_sock_index_service),
+    limit: int = Query(10, ge=1, le=100, description="Maximum number of similar socks (1-100)")
 ):
     """Search for similar socks using an existing sock's embedding."""
     start_time = time.time()
-    # Get the source sock
-    sock = db.query(Sock).filter(Sock.id == sock_id).first()
+    # Get the source sock (only the columns the search needs, no ORM hydration)
+    # The session is synchronous, so queries run in the threadpool to keep the event loop free
+    sock = await run_in_threadpool(
+        lambda: db.query(Sock.owner_id, Sock.embedding).filter(Sock.id == sock_id).first()
+    )
     if not sock:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -581,28 +977,37 @@ async def search_by_sock_id(
     # Get the embedding
     query_embedding = embedding_service.embedding_from_bytes(sock.embedding)
     
-    # Get all unmatched socks from the current user (excluding this one)
-    socks = db.query(Sock).filter(
-        Sock.owner_id == current_user.id,
-        Sock.is_matched == False,
-        Sock.id != sock_id
-    ).all()
-    
-    # Calculate similarities
-    matches = []
-    for other_sock in socks:
-        sock_embedding = embedding_service.embedding_from_bytes(other_sock.embedding)
-        similarity = embedding_service.calculate_similarity(query_embedding, sock_embedding)
-        matches.append(SockMatch(sock_id=other_sock.id, similarity=similarity))
+    # Search the user's cached embedding matrix / HNSW index, building it on first use or
+    # when another process changed the user's socks since (the version was read with the user)
+    sock_set_version = current_user.sock_set_version
+    sock_index = sock_index_service.get(current_user.id, sock_set_version)
+    if sock_index is None:
+        # Get the embeddings of all unmatched socks from the current user (plain rows, no ORM objects)
+        rows = await run_in_threadpool(
+            lambda: db.query(Sock.id, Sock.embedding).filter(
+                Sock.owner_id == current_user.id,
+                Sock.is_matched == False
+            ).all()
+        )
+        
+        sock_index = sock_index_service.build(
+            current_user.id,
+            sock_set_version,
+            [row.id for row in rows],
+            embedding_service.embeddings_from_bytes([row.embedding for row in rows])
+        )
     
-    # Sort by similarity (highest first) and limit results
-    matches.sort(key=lambda x: x.similarity, reverse=True)
+    matches = [
+        SockMatch(sock_id=other_sock_id, similarity=similarity)
+        for other_sock_id, similarity in await get_search_batcher().search(sock_index, query_embedding, limit, exclude_id=sock_id)
+    ]
+    candidates_checked = len(sock_index)
     
     duration_ms = (time.time() - start_time) * 1000
     log_with_context(logger, "info", "Similarity search completed",
         sock_id=sock_id,
         user_id=current_user.id,
-        candidates_checked=len(socks),
+        candidates_checked=candidates_checked,
         matches_found=len(matches[:limit]),
         duration_ms=round(duration_ms, 2),
         event="similarity_search")
@@ -613,6 +1018,7 @@ async def search_by_sock_id(
 @router.delete("/{sock_id}", status_code=status.HTTP_204_NO_CONTENT)
 def delete_sock(
     sock_id: int,
+    background_tasks: BackgroundTasks,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
@@ -648,31 +1054,15 @@ def delete_sock(
             detail="Cannot delete a matched sock. Delete the match first."
         )
     
-    # Delete the image file if it exists
-    if os.path.exists(sock.image_path):
-        try:
-            os.remove(sock.image_path)
-        except Exception as e:
-            # Log error but continue with database deletion
-            log_error(logger, "Failed to delete image file", exc=e,
-                sock_id=sock_id,
-                image_path=sock.image_path,
-                event="image_delete_error")
-    
-    # Delete the background-removed image file if it exists
-    if sock.image_no_bg_path and os.path.exists(sock.image_no_bg_path):
-        try:
-            os.remove(sock.image_no_bg_path)
-        except Exception as e:
-            # Log error but continue with database deletion
-            log_error(logger, "Failed to delete background-removed image", exc=e,
-                sock_id=sock_id,
-                image_path=sock.image_no_bg_path,
-                event="bg_image_delete_error")
-    
     # Delete the sock from database
+    sock_files = [path for path in (sock.image_path, sock.image_no_bg_path, sock.thumbnail_path) if path]
     db.delete(sock)
+    sock_set_version = bump_sock_set_version(db, current_user.id)
     db.commit()
+    get_sock_index_service().remove(current_user.id, sock_set_version, [sock_id])
+    
+    # Unlink the image files and cached variants after the response is sent
+    background_tasks.add_task(remove_sock_files, settings.upload_dir, sock_id, sock_files)
     
     log_with_context(logger, "info", "Sock deleted successfully",
         sock_id=sock_id,
@@ -0,0 +1,306 @@
+import asyncio
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+
+from app.config import get_settings
+from app.models import User
+
+
+# Below this many unmatched socks an exact flat scan is fast enough (about a millisecond)
+HNSW_MIN_SOCKS = 2000
+# Graph degree and build/search beam widths of the HNSW index
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 100
+HNSW_EF_SEARCH = 64
+# Rebuild an HNSW index once this fraction of its entries are tombstoned removals
+HNSW_MAX_TOMBSTONE_RATIO = 0.2
+
+
+def _as_matrix(embeddings: np.ndarray) -> np.ndarray:
+    """
+    View embeddings as a contiguous float32 (N, d) matrix for FAISS.
+    Stored embeddings are already unit length (see EmbeddingService.create_embedding),
+    so the inner product is the cosine similarity without renormalizing here.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    return np.ascontiguousarray(embeddings.reshape(-1, embeddings.shape[-1]))
+
+
+class UserSockIndex:
+    """
+    FAISS inner-product index over the embeddings of one user's unmatched socks,
+    keyed by sock id. Embeddings are unit length, so scores are cosine similarities.
+    Small collections use an exact flat index; large ones an HNSW graph, where
+    removed socks are tombstoned (HNSW graphs don't support removal) and filtered
+    out of search results.
+    """
+
+    def __init__(self, sock_ids: np.ndarray, embeddings: np.ndarray, dim: int):
+        self.is_hnsw = len(sock_ids) >= HNSW_MIN_SOCKS
+        if self.is_hnsw:
+            self.base = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            self.base.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        else:
+            self.base = faiss.IndexFlatIP(dim)
+        self.index = faiss.IndexIDMap2(self.base)
+        if len(sock_ids):
+            self.index.add_with_ids(_as_matrix(embeddings), np.asarray(sock_ids, dtype=np.int64))
+        self._ids = set(int(sock_id) for sock_id in sock_ids)
+        self._tombstones = set()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    @property
+    def needs_rebuild(self) -> bool:
+        """Whether so many entries are tombstoned that searches waste most of their work."""
+        return len(self._tombstones) > HNSW_MAX_TOMBSTONE_RATIO * self.index.ntotal
+
+    def add(self, sock_id: int, embedding: np.ndarray) -> bool:
+        """
+        Add one sock to the index (no-op if it is already in it).
+        Returns False if the index can't take it and has to be rebuilt instead.
+        """
+        vector = _as_matrix(embedding)
+        with self._lock:
+            if sock_id in self._ids:
+                return True
+            if sock_id in self._tombstones:
+                # A decoupled sock is still in the graph and can simply be revived,
+                # unless the id was reused by a new sock with a different embedding
+                if not np.allclose(self.index.reconstruct(sock_id), vector[0]):
+                    return False
+                self._tombstones.discard(sock_id)
+                self._ids.add(sock_id)
+                return True
+            self.index.add_with_ids(vector, np.array([sock_id], dtype=np.int64))
+            self._ids.add(sock_id)
+            return True
+
+    def remove(self, sock_ids: List[int]) -> None:
+        """Remove socks from the index."""
+        with self._lock:
+            present = [sock_id for sock_id in sock_ids if sock_id in self._ids]
+            if not present:
+                return
+            if self.is_hnsw:
+                self._tombstones.update(present)
+            else:
+                self.index.remove_ids(np.asarray(present, dtype=np.int64))
+            self._ids.difference_update(present)
+
+    def search(self, query: np.ndarray, limit: int, exclude_id: int) -> List[Tuple[int, float]]:
+        """
+        Find the most similar socks to a query embedding.
+
+        Args:
+            query: Query embedding
+            limit: Maximum number of results
+            exclude_id: Sock id to leave out of the results (the query sock itself)
+
+        Returns:
+            List of (sock_id, cosine similarity) tuples, most similar first
+        """
+        return self.search_many(query, [limit], [exclude_id])[0]
+
+    def search_many(self, queries: np.ndarray, limits: List[int], exclude_ids: List[int]) -> List[List[Tuple[int, float]]]:
+        """Run several searches (one query embedding per row) with a single FAISS call, see search()."""
+        queries = _as_matrix(queries)
+        with self._lock:
+            if not self._ids:
+                return [[] for _ in limits]
+            # Over-fetch to make up for the query sock and tombstoned entries
+            k = max(min(max(limits) + 1 + len(self._tombstones), self.index.ntotal), 1)
+            if self.is_hnsw:
+                self.base.hnsw.efSearch = max(HNSW_EF_SEARCH, k)
+            similarities, ids = self.index.search(queries, k)
+            tombstones = set(self._tombstones)
+
+        all_results = []
+        for row_similarities, row_ids, limit, exclude_id in zip(similarities, ids, limits, exclude_ids):
+            results = []
+            for similarity, sock_id in zip(row_similarities, row_ids):
+                if sock_id >= 0 and sock_id != exclude_id and sock_id not in tombstones:
+                    results.append((int(sock_id), float(similarity)))
+            all_results.append(results[:max(limit, 0)])
+        return all_results
+
+
+def bump_sock_set_version(db: Session, user_id: int) -> int:
+    """
+    Increment a user's sock set version in the current transaction and return the new value.
+    Call it with every change to the user's unmatched socks, before committing.
+    """
+    return db.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(sock_set_version=User.sock_set_version + 1)
+        .returning(User.sock_set_version)
+    ).scalar_one()
+
+
+class SockIndexService:
+    """
+    Keeps a per-user search index of unmatched sock embeddings in memory, so
+    searches don't reload and decode every embedding from the database.
+    Entries are built lazily on search and kept up to date as socks are
+    uploaded, deleted, matched and unmatched.
+    
+    Each index is tagged with the user's sock set version (User.sock_set_version)
+    it reflects. Other API processes change socks too, so an index older than the
+    version read from the database is rebuilt, and in-place updates are only
+    applied to an index that has seen every earlier change.
+    """
+
+    def __init__(self):
+        self._indices: Dict[int, UserSockIndex] = {}
+        self._versions: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int, version: int) -> Optional[UserSockIndex]:
+        """Get the cached index for a user, unless it is older than the given sock set version."""
+        with self._lock:
+            index = self._indices.get(user_id)
+            if index is None or self._versions[user_id] < version:
+                return None
+            return index
+
+    def build(self, user_id: int, version: int, sock_ids: List[int], embeddings: np.ndarray) -> UserSockIndex:
+        """
+        Build the index for a user from an (N, D) embedding matrix.
+        `version` must be read before loading the socks; the index is cached unless a newer one already is.
+        """
+        dim = embeddings.shape[1] if len(sock_ids) else get_settings().embedding_dim
+        index = UserSockIndex(np.asarray(sock_ids, dtype=np.int64), embeddings, dim)
+        with self._lock:
+            if self._versions.get(user_id, -1) <= version:
+                self._indices[user_id] = index
+                self._versions[user_id] = version
+        return index
+
+    def add(self, user_id: int, version: int, sock_ids: List[int], embeddings: np.ndarray) -> None:
+        """Add socks that became unmatched (uploaded or decoupled) in the change that produced `version`."""
+        with self._lock:
+            index = self._advance(user_id, version)
+            if index is None:
+                return
+            if not index.is_hnsw and len(index) + len(sock_ids) >= HNSW_MIN_SOCKS:
+                # Grown past exact-scan size: rebuild as HNSW on the next search
+                self._drop(user_id)
+                return
+            for sock_id, embedding in zip(sock_ids, embeddings):
+                if not index.add(sock_id, embedding):
+                    self._drop(user_id)
+                    return
+
+    def remove(self, user_id: int, version: int, sock_ids: List[int]) -> None:
+        """Remove socks that are no longer unmatched (deleted or matched) in the change that produced `version`."""
+        with self._lock:
+            index = self._advance(user_id, version)
+            if index is None:
+                return
+            index.remove(sock_ids)
+            if index.is_hnsw and index.needs_rebuild:
+                # Rebuild without the tombstoned entries on the next search
+                self._drop(user_id)
+
+    def invalidate(self, user_id: int) -> None:
+        """Drop the cached index for a user."""
+        with self._lock:
+            self._drop(user_id)
+
+    def _advance(self, user_id: int, version: int) -> Optional[UserSockIndex]:
+        # The cached index to update in place for the change that produced `version`, if any
+        index = self._indices.get(user_id)
+        if index is None:
+            return None
+        cached_version = self._versions[user_id]
+        if cached_version >= version:
+            # Built after this change was committed, it already reflects it
+            return None
+        if cached_version != version - 1:
+            # Missed changes made by another process: rebuild on the next search
+            self._drop(user_id)
+            return None
+        self._versions[user_id] = version
+        return index
+
+    def _drop(self, user_id: int) -> None:
+        self._indices.pop(user_id, None)
+        self._versions.pop(user_id, None)
+
+
+class SearchBatcher:
+    """
+    Coalesces searches against the same user index that arrive within a short
+    window into one FAISS call, which runs in a worker thread instead of on the
+    event loop.
+    """
+
+    def __init__(self, window_seconds: float):
+        self.window_seconds = window_seconds
+        # Keyed by id(index); the pending entry keeps the index alive, so the id can't be reused
+        self._pending: Dict[int, Tuple[UserSockIndex, list]] = {}
+        self._tasks = set()
+
+    async def search(self, index: UserSockIndex, query: np.ndarray, limit: int, exclude_id: int) -> List[Tuple[int, float]]:
+        """Same as index.search(), batched with other searches on that index."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        key = id(index)
+        if key not in self._pending:
+            self._pending[key] = (index, [])
+            loop.call_later(self.window_seconds, self._start, key)
+        self._pending[key][1].append((query, limit, exclude_id, future))
+        return await future
+
+    def _start(self, key: int) -> None:
+        task = asyncio.ensure_future(self._run(*self._pending.pop(key)))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, index: UserSockIndex, requests: list) -> None:
+        queries = np.stack([query for query, _, _, _ in requests])
+        limits = [limit for _, limit, _, _ in requests]
+        exclude_ids = [exclude_id for _, _, exclude_id, _ in requests]
+        futures = [future for _, _, _, future in requests]
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(
+                None, index.search_many, queries, limits, exclude_ids
+            )
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, result in zip(futures, results):
+            # Skip callers that went away (request cancelled)
+            if not future.done():
+                future.set_result(result)
+
+
+# Singleton instances
+_sock_index_service = None
+_search_batcher = None
+
+
+def get_sock_index_service() -> SockIndexService:
+    """Get or create the sock index service singleton."""
+    global _sock_index_service
+    if _sock_index_service is None:
+        _sock_index_service = SockIndexService()
+    return _sock_index_service
+
+
+def get_search_batcher() -> SearchBatcher:
+    """Get or create the search batcher singleton."""
+    global _search_batcher
+    if _search_batcher is None:
+        _search_batcher = SearchBatcher(get_settings().search_batch_window_ms / 1000)
+    return _search_batcher